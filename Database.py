@@ -1,110 +1,71 @@
+import json
 import os
-import sqlite3
+import threading
 from typing import Any
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+from database import (
+    init_db,
+    load_goal,
+    load_subjects,
+    save_goal,
+    save_subjects,
+    state_generation,
+)
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "subjects.db")
-SLOT_COUNT = 5
+
+
+# Worker threads serving requests.
+THREADS = int(os.environ.get("SUBJECTS_API_THREADS", "4"))
 
 app = Flask(__name__)
 
+# Serialized GET bodies, each tagged with the state generation it was built
+# from. GETs serve them without locking while the generation still matches and
+# rebuild them once it moves, whether this process wrote or the state was
+# reloaded after another process did. The generation is read before the state,
+# so a body is never tagged newer than the data in it.
+_SUBJECTS_JSON: tuple[int, bytes] | None = None
+_GOAL_JSON: tuple[int, bytes] | None = None
+_json_lock = threading.Lock()
 
-def _get_connection() -> sqlite3.Connection:
-    connection = sqlite3.connect(DB_PATH)
-    connection.row_factory = sqlite3.Row
-    return connection
-
-
-def init_db() -> None:
-    with _get_connection() as connection:
-        connection.execute(
-            """
-            CREATE TABLE IF NOT EXISTS subject_slots (
-                slot INTEGER PRIMARY KEY,
-                subject TEXT NOT NULL,
-                current TEXT NOT NULL,
-                target TEXT NOT NULL,
-                updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
-            )
-            """
-        )
-        connection.execute(
-            """
-            CREATE TABLE IF NOT EXISTS goals (
-                id INTEGER PRIMARY KEY,
-                goal TEXT NOT NULL,
-                updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
-            )
-            """
-        )
-
-
-def _load_subjects() -> list[dict[str, Any] | None]:
-    init_db()
-    subjects: list[dict[str, Any] | None] = [None] * SLOT_COUNT
-    with _get_connection() as connection:
-        rows = connection.execute(
-            "SELECT slot, subject, current, target FROM subject_slots ORDER BY slot"
-        ).fetchall()
-    for row in rows:
-        if 0 <= row["slot"] < SLOT_COUNT:
-            subjects[row["slot"]] = {
-                "subject": row["subject"],
-                "current": row["current"],
-                "target": row["target"],
-            }
-    return subjects
-
-
-def _save_subjects(subjects: list[dict[str, Any] | None]) -> None:
-    init_db()
-    if len(subjects) != SLOT_COUNT:
-        raise ValueError(f"Expected {SLOT_COUNT} slots, got {len(subjects)}.")
-
-    with _get_connection() as connection:
-        connection.execute("DELETE FROM subject_slots")
-        for slot, item in enumerate(subjects):
-            if not item:
-                continue
-            connection.execute(
-                """
-                INSERT INTO subject_slots (slot, subject, current, target)
-                VALUES (?, ?, ?, ?)
-                """,
-                (
-                    slot,
-                    str(item.get("subject", "")),
-                    str(item.get("current", "")),
-                    str(item.get("target", "")),
-                ),
-            )
-
-
-def save_goal(goal: str) -> None:
-    init_db()
-    with _get_connection() as connection:
-        connection.execute(
-            """
-            INSERT INTO goals (id, goal)
-            VALUES (1, ?)
-            ON CONFLICT(id) DO UPDATE SET
-                goal = excluded.goal,
-                updated_at = CURRENT_TIMESTAMP
-            """,
-            (goal,),
-        )
-
-
-def load_goal() -> str:
-    init_db()
-    with _get_connection() as connection:
-        row = connection.execute(
-            "SELECT goal FROM goals WHERE id = 1"
-        ).fetchone()
-    return row["goal"] if row else ""
+
+def _subjects_json() -> bytes:
+    global _SUBJECTS_JSON
+    cached = _SUBJECTS_JSON
+    if cached is not None and cached[0] == state_generation():
+        return cached[1]
+    with _json_lock:
+        generation = state_generation()
+        _SUBJECTS_JSON = (generation, _dumps(load_subjects()))
+        return _SUBJECTS_JSON[1]
+
+
+def _goal_json() -> bytes:
+    global _GOAL_JSON
+    cached = _GOAL_JSON
+    if cached is not None and cached[0] == state_generation():
+        return cached[1]
+    with _json_lock:
+        generation = state_generation()
+        _GOAL_JSON = (generation, _dumps({"goal": load_goal()}))
+        return _GOAL_JSON[1]
+
+
+def _dumps(payload: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+def _json_response(body: bytes) -> Response:
+    return Response(body, mimetype="application/json")
 
 
 @app.after_request
@@ -117,7 +78,7 @@ def add_cors_headers(response):
 
 @app.route("/api/subjects", methods=["GET"])
 def get_subjects():
-    return jsonify(_load_subjects())
+    return _json_response(_subjects_json())
 
 
 @app.route("/api/subjects", methods=["POST"])
@@ -127,16 +88,18 @@ def set_subjects():
         return jsonify({"error": "Payload must be a list."}), 400
 
     try:
-        _save_subjects(payload)
-    except ValueError as exc:
+        written = save_subjects(payload)
+    except (TypeError, ValueError) as exc:
         return jsonify({"error": str(exc)}), 400
 
+    if not written:
+        return jsonify({"status": "ok", "cached": True})
     return jsonify({"status": "ok"})
 
 
 @app.route("/api/goal", methods=["GET"])
 def get_goal():
-    return jsonify({"goal": load_goal()})
+    return _json_response(_goal_json())
 
 
 @app.route("/api/goal", methods=["POST"])
@@ -144,13 +107,21 @@ def set_goal():
     payload = request.get_json(silent=True)
     if not isinstance(payload, dict) or "goal" not in payload:
         return jsonify({"error": "Payload must be a dict with 'goal' key."}), 400
+    if not isinstance(payload["goal"], str):
+        return jsonify({"error": "Payload 'goal' must be a string."}), 400
 
-    save_goal(payload["goal"])
+    if not save_goal(payload["goal"]):
+        return jsonify({"status": "ok", "cached": True})
     return jsonify({"status": "ok"})
 
 
 if __name__ == "__main__":
     init_db()
-    app.run(host="127.0.0.1", port=5000, debug=True) 
+    try:
+        from waitress import serve
+    except ImportError:
+        app.run(host="127.0.0.1", port=5000, debug=True)
+    else:
+        serve(app, host="127.0.0.1", port=5000, threads=THREADS) 
 
 
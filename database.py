@@ -1,160 +1,301 @@
-import json
 import os
 import sqlite3
+import threading
+from collections.abc import Iterator
 from contextlib import contextmanager
 from typing import Any
 
 
-DEFAULT_DB_PATH = os.environ.get("SUBJECTS_DB_PATH", "subjects.db")
+DEFAULT_DB_PATH = os.environ.get(
+    "SUBJECTS_DB_PATH", os.path.join(os.path.dirname(__file__), "subjects.db")
+)
 SLOT_COUNT = 5
-SUBJECTS_KEY = "subjects"
+# NORMAL is safe under WAL and skips the fsync of the main database file on
+# commit; set SUBJECTS_DB_SYNCHRONOUS=FULL to fsync on every commit instead.
+DB_SYNCHRONOUS = os.environ.get("SUBJECTS_DB_SYNCHRONOUS", "NORMAL").upper()
+if DB_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise ValueError(f"Invalid SUBJECTS_DB_SYNCHRONOUS: {DB_SYNCHRONOUS!r}.")
+# A stored subject slot: (slot, subject, current, target).
+SlotRow = tuple[int, str, str, str]
 
-# In-memory cache for the latest saved subjects payload.
-subjects: dict[str, dict[str, str]] = {}
+# Shared SQL strings so every caller hits the same cached prepared statement.
+_SQL_LOAD_SLOTS = (
+    "SELECT slot, subject, current, target FROM subject_slots ORDER BY slot"
+)
+_SQL_UPSERT_SLOT = """
+    INSERT INTO subject_slots (slot, subject, current, target)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(slot) DO UPDATE SET
+        subject = excluded.subject,
+        current = excluded.current,
+        target = excluded.target,
+        updated_at = CURRENT_TIMESTAMP
+"""
+_SQL_LOAD_GOAL = "SELECT goal FROM goals WHERE id = 1"
+_SQL_UPSERT_GOAL = """
+    INSERT INTO goals (id, goal)
+    VALUES (1, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        goal = excluded.goal,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+# Database files already switched to WAL; the journal mode is persisted in the
+# file itself, so each path only needs the PRAGMA once per process.
+_wal_paths: set[str] = set()
+_initialized_paths: set[str] = set()
+_init_lock = threading.Lock()
+
+# One long-lived connection per database path, opened on first use. Every
+# load and write goes through it with _state_lock held, so a single connection
+# per path is all that is ever in use; this also lets ":memory:" databases be
+# shared by all threads.
+_connections: dict[str, sqlite3.Connection] = {}
+# A second connection per file that readers use only to poll PRAGMA
+# data_version, so they never wait on _state_lock behind a write just to find
+# out nothing changed.
+_read_connections: dict[str, sqlite3.Connection] = {}
+_read_versions: dict[str, int] = {}
+_read_lock = threading.Lock()
+
+# In-memory copy of everything stored under each database path, loaded by
+# init_db(). Reads are served from here without locking or touching SQLite;
+# writes are serialized by _state_lock, committed, and then swap in a new value
+# (stored lists are never mutated in place). A save whose payload matches the
+# current state writes nothing.
+_subjects_state: dict[str, list[SlotRow]] = {}
+_goal_state: dict[str, str] = {}
+_state_lock = threading.Lock()
+# PRAGMA data_version as of the last state load. It only changes when some
+# other connection (e.g. another process) commits to the file, which means the
+# state is stale and is reloaded before the next write or read uses it.
+_data_versions: dict[str, int] = {}
+# Bumped every time a path's state is swapped, whether by a write or a reload,
+# so callers can tell whether anything they derived from it is still current.
+_state_generations: dict[str, int] = {}
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(db_path, check_same_thread=False)
+    if db_path != ":memory:":
+        if db_path not in _wal_paths:
+            connection.execute("PRAGMA journal_mode=WAL")
+            _wal_paths.add(db_path)
+        connection.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        connection.execute("PRAGMA busy_timeout=5000")
+        # Serve page reads from a memory map instead of read() calls; SQLite
+        # only maps as much of the file as exists, up to this cap.
+        connection.execute("PRAGMA mmap_size=268435456")
+    connection.execute("PRAGMA temp_store=MEMORY")
+    connection.execute("PRAGMA cache_size=-8000")
+    return connection
 
 
 @contextmanager
 def _get_connection(db_path: str = DEFAULT_DB_PATH):
-    connection = sqlite3.connect(db_path)
-    try:
+    # Callers must hold _state_lock.
+    connection = _connections.get(db_path)
+    if connection is None:
+        connection = _connections[db_path] = _connect(db_path)
+    with connection:
         yield connection
-        connection.commit()
-    except Exception:
-        connection.rollback()
-        raise
-    finally:
-        connection.close()
 
 
 def init_db(db_path: str = DEFAULT_DB_PATH) -> None:
-    with _get_connection(db_path) as connection:
-        connection.execute(
-            """
-            CREATE TABLE IF NOT EXISTS subject_entries (
-                name TEXT PRIMARY KEY,
-                value TEXT NOT NULL,
-                updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    # Only the first call per path runs the DDL and loads the state; every
+    # later call (one per load/save) is just a set lookup.
+    if db_path in _initialized_paths:
+        return
+    with _init_lock:
+        if db_path in _initialized_paths:
+            return
+        with _state_lock, _get_connection(db_path) as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS subject_slots (
+                    slot INTEGER PRIMARY KEY,
+                    subject TEXT NOT NULL,
+                    current TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+                """
             )
-            """
-        )
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS goals (
+                    id INTEGER PRIMARY KEY,
+                    goal TEXT NOT NULL,
+                    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+                """
+            )
+            _load_state(connection, db_path)
+        _initialized_paths.add(db_path)
 
 
-def save_subjects(subject_data: dict[str, str], db_path: str = DEFAULT_DB_PATH) -> None:
-    if not isinstance(subject_data, dict):
-        raise TypeError("subject_data must be a dict of {name: value}.")
+def _load_state(connection: sqlite3.Connection, db_path: str) -> None:
+    rows = connection.execute(_SQL_LOAD_SLOTS).fetchall()
+    row = connection.execute(_SQL_LOAD_GOAL).fetchone()
+    _subjects_state[db_path] = rows
+    _goal_state[db_path] = row[0] if row else ""
+    _data_versions[db_path] = _data_version(connection)
+    _bump_generation(db_path)
 
-    init_db(db_path)
-    with _get_connection(db_path) as connection:
-        connection.executemany(
-            """
-            INSERT INTO subject_entries (name, value, updated_at)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(name) DO UPDATE SET
-                value = excluded.value,
-                updated_at = CURRENT_TIMESTAMP
-            """,
-            [(name, value) for name, value in subject_data.items()],
-        )
 
+def _bump_generation(db_path: str) -> None:
+    _state_generations[db_path] = _state_generations.get(db_path, 0) + 1
 
-def save_subject(name: str, value: str, db_path: str = DEFAULT_DB_PATH) -> None:
-    if not name:
-        raise ValueError("name must be a non-empty string.")
 
-    init_db(db_path)
-    with _get_connection(db_path) as connection:
-        connection.execute(
-            """
-            INSERT INTO subject_entries (name, value, updated_at)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(name) DO UPDATE SET
-                value = excluded.value,
-                updated_at = CURRENT_TIMESTAMP
-            """,
-            (name, value),
-        )
+def _data_version(connection: sqlite3.Connection) -> int:
+    return connection.execute("PRAGMA data_version").fetchone()[0]
 
 
-def load_subjects(db_path: str = DEFAULT_DB_PATH) -> dict[str, str]:
-    init_db(db_path)
-    with _get_connection(db_path) as connection:
-        rows = connection.execute(
-            "SELECT name, value FROM subject_entries ORDER BY name"
-        ).fetchall()
-    return {name: value for name, value in rows}
+def _refresh_if_stale(db_path: str) -> None:
+    # Nothing outside this process can write to an in-memory database.
+    if db_path == ":memory:":
+        return
+    with _read_lock:
+        connection = _read_connections.get(db_path)
+        if connection is None:
+            connection = _read_connections[db_path] = _connect(db_path)
+        version = _data_version(connection)
+        if version == _read_versions.get(db_path):
+            return
+    # Some connection committed. If it was our own writer the state is already
+    # current; if a write is running right now it refreshes the state itself,
+    # so leave the version unrecorded and check again on the next read.
+    if not _state_lock.acquire(blocking=False):
+        return
+    try:
+        with _get_connection(db_path) as connection:
+            if _data_version(connection) != _data_versions[db_path]:
+                _load_state(connection, db_path)
+        _read_versions[db_path] = version
+    finally:
+        _state_lock.release()
+
 
+def _begin_write(connection: sqlite3.Connection, db_path: str) -> None:
+    # Take the write lock up front so the whole save is one transaction and
+    # never has to upgrade a deferred read lock; once it is held nobody else
+    # can commit, so the state can be refreshed and compared safely.
+    connection.execute("BEGIN IMMEDIATE")
+    if _data_version(connection) != _data_versions[db_path]:
+        _load_state(connection, db_path)
 
-def _normalize_subject_payload(
+
+def _iter_slot_rows(
     subject_list: list[dict[str, Any] | None],
     slot_count: int = SLOT_COUNT,
-) -> dict[str, dict[str, str]]:
+) -> Iterator[SlotRow]:
+    # Validates and normalizes in the same pass that yields the
+    # (slot, subject, current, target) rows for executemany.
     if not isinstance(subject_list, list):
         raise TypeError("subject_list must be a list.")
     if len(subject_list) != slot_count:
         raise ValueError(f"Expected {slot_count} slots, got {len(subject_list)}.")
 
-    normalized: dict[str, dict[str, str]] = {}
     for index, item in enumerate(subject_list):
-        if not item:
+        if item is None:
             continue
         if not isinstance(item, dict):
             raise TypeError(f"subject_list[{index}] must be a dict or null.")
-        normalized[str(index)] = {
-            "subject": str(item.get("subject", "")).strip(),
-            "current": str(item.get("current", "")).strip(),
-            "target": str(item.get("target", "")).strip(),
-        }
-    return normalized
+        if not item:
+            # An empty dict clears the slot, the same as null.
+            continue
+        yield (
+            index,
+            str(item.get("subject", "")).strip(),
+            str(item.get("current", "")).strip(),
+            str(item.get("target", "")).strip(),
+        )
 
 
-def save_subjects_snapshot(
+def _rows_to_subject_list(
+    rows: list[SlotRow],
+    slot_count: int = SLOT_COUNT,
+) -> list[dict[str, str] | None]:
+    subject_list: list[dict[str, str] | None] = [None] * slot_count
+    for slot, subject, current, target in rows:
+        if 0 <= slot < slot_count:
+            subject_list[slot] = {
+                "subject": subject,
+                "current": current,
+                "target": target,
+            }
+    return subject_list
+
+
+# The save functions return False, without writing anything, when the payload
+# matches what is already stored.
+def save_subjects(
     subject_list: list[dict[str, Any] | None],
     db_path: str = DEFAULT_DB_PATH,
     slot_count: int = SLOT_COUNT,
-) -> None:
-    global subjects
-    subjects = _normalize_subject_payload(subject_list, slot_count)
-    save_subject(SUBJECTS_KEY, json.dumps(subjects), db_path=db_path)
+) -> bool:
+    rows = list(_iter_slot_rows(subject_list, slot_count))
+    init_db(db_path)
+    with _state_lock:
+        with _get_connection(db_path) as connection:
+            _begin_write(connection, db_path)
+            if _subjects_state[db_path] == rows:
+                return False
+            # Update existing slots in place rather than wiping and
+            # reinserting the table, then drop only the slots that were cleared.
+            connection.executemany(_SQL_UPSERT_SLOT, rows)
+            connection.execute(
+                "DELETE FROM subject_slots WHERE slot NOT IN "
+                f"({', '.join('?' * len(rows))})",
+                [row[0] for row in rows],
+            )
+        _subjects_state[db_path] = rows
+        _bump_generation(db_path)
+    return True
 
 
-def load_subjects_snapshot(
+def load_subjects(
     db_path: str = DEFAULT_DB_PATH,
     slot_count: int = SLOT_COUNT,
 ) -> list[dict[str, str] | None]:
-    global subjects
     init_db(db_path)
-    with _get_connection(db_path) as connection:
-        row = connection.execute(
-            "SELECT value FROM subject_entries WHERE name = ?",
-            (SUBJECTS_KEY,),
-        ).fetchone()
-
-    subjects = {}
-    if row and row[0]:
-        try:
-            stored = json.loads(row[0])
-        except json.JSONDecodeError:
-            stored = {}
-        if isinstance(stored, dict):
-            for key, value in stored.items():
-                if not isinstance(value, dict):
-                    continue
-                subjects[str(key)] = {
-                    "subject": str(value.get("subject", "")).strip(),
-                    "current": str(value.get("current", "")).strip(),
-                    "target": str(value.get("target", "")).strip(),
-                }
-
-    return [subjects.get(str(i)) for i in range(slot_count)]
+    _refresh_if_stale(db_path)
+    # Built fresh on every call, so callers cannot mutate the stored rows.
+    return _rows_to_subject_list(_subjects_state[db_path], slot_count)
+
+
+def save_goal(goal: str, db_path: str = DEFAULT_DB_PATH) -> bool:
+    init_db(db_path)
+    with _state_lock:
+        with _get_connection(db_path) as connection:
+            _begin_write(connection, db_path)
+            if _goal_state[db_path] == goal:
+                return False
+            connection.execute(_SQL_UPSERT_GOAL, (goal,))
+        _goal_state[db_path] = goal
+        _bump_generation(db_path)
+    return True
+
+
+def load_goal(db_path: str = DEFAULT_DB_PATH) -> str:
+    init_db(db_path)
+    _refresh_if_stale(db_path)
+    return _goal_state[db_path]
+
+
+def state_generation(db_path: str = DEFAULT_DB_PATH) -> int:
+    init_db(db_path)
+    _refresh_if_stale(db_path)
+    return _state_generations[db_path]
 
 
 __all__ = [
     "DEFAULT_DB_PATH",
+    "SLOT_COUNT",
     "init_db",
     "save_subjects",
-    "save_subject",
     "load_subjects",
-    "save_subjects_snapshot",
-    "load_subjects_snapshot",
-    "subjects",
+    "save_goal",
+    "load_goal",
+    "state_generation",
 ]